@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019-2020 Mircea Ulinic. All rights reserved.
+#
+# The contents of this file are licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+'''
+Publish jobs from the Master, and stream the returns from the event bus.
+'''
+import time
+import queue
+import threading
+
+import salt.client
+import salt.exceptions
+import salt.utils.jid
+import salt.utils.event
+
+
+class Job(object):
+    '''
+    A job published by :class:`JobStream`. Iterate over it to get the returns
+    as they arrive; ``missing`` holds the Minions that didn't return (yet).
+    '''
+
+    def __init__(self, opts, buffer_size, timeout):
+        self.opts = opts
+        self.jid = salt.utils.jid.gen_jid(opts)
+        self.timeout = timeout
+        self.missing = []
+        self._returns = queue.Queue(maxsize=buffer_size)
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._error = None
+        self._published = None
+
+    def _listen(self):
+        try:
+            event = salt.utils.event.get_master_event(
+                self.opts, self.opts['sock_dir'], listen=True
+            )
+            event.connect_pub()
+        except Exception as err:  # pylint: disable=broad-except
+            self._error = err
+            self._ready.set()
+            return
+        self._ready.set()
+        tag = 'salt/job/{}/ret/'.format(self.jid)
+        try:
+            # Stop at the timeout as well, in case the job is never iterated.
+            while not self._stop.is_set() and not self._expired():
+                ret = event.get_event(wait=0.5, tag=tag, full=True)
+                if not ret:
+                    continue
+                received = time.time()
+                # When the buffer is full and the job is not iterated, drop
+                # the return once the job expires, instead of blocking forever.
+                while not self._stop.is_set() and not self._expired():
+                    try:
+                        self._returns.put((received, ret['data']), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+        finally:
+            event.destroy()
+
+    def _expired(self):
+        return (
+            self._published is not None
+            and time.time() > self._published + self.timeout
+        )
+
+    def publish(self, tgt, fun, arg=(), tgt_type='glob', kwarg=None):
+        '''
+        Subscribe to the event bus, then publish the job.
+        '''
+        listener = threading.Thread(
+            target=self._listen, name='isalt-events-{}'.format(self.jid)
+        )
+        listener.daemon = True
+        listener.start()
+        # Subscribe before publishing, so fast returns are not missed.
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        client = salt.client.get_local_client(mopts=self.opts)
+        self._published = time.time()
+        try:
+            pub_data = client.run_job(
+                tgt, fun, arg=arg, tgt_type=tgt_type, jid=self.jid, kwarg=kwarg
+            )
+        except Exception:
+            self.close()
+            raise
+        finally:
+            # The returns are collected from the event bus, not by the client.
+            client.destroy()
+        if not pub_data:
+            self.close()
+            raise salt.exceptions.SaltClientError(
+                'Unable to publish the job {}'.format(self.jid)
+            )
+        self.missing = sorted(pub_data.get('minions', []))
+        return self
+
+    def close(self):
+        '''
+        Stop listening to the event bus.
+        '''
+        self._stop.set()
+
+    def __iter__(self):
+        pending = set(self.missing)
+        deadline = self._published + self.timeout
+        try:
+            while pending:
+                # The returns already buffered are yielded even when the job is
+                # iterated after the timeout, as long as they arrived in time.
+                try:
+                    received, data = self._returns.get_nowait()
+                except queue.Empty:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        received, data = self._returns.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if received > deadline:
+                    continue
+                pending.discard(data['id'])
+                self.missing = sorted(pending)
+                yield {
+                    data['id']: {
+                        'ret': data.get('return'),
+                        'retcode': data.get('retcode'),
+                        'success': data.get('success'),
+                        'latency': received - self._published,
+                    }
+                }
+        finally:
+            self.close()
+
+
+class JobStream(object):
+    '''
+    Publish execution jobs through the LocalClient, and yield the returns as
+    they arrive on the Master event bus. The events are consumed in
+    a background thread, into a buffer of at most ``buffer_size`` returns: when
+    the job is not iterated, the returns exceeding the buffer are dropped once
+    the job times out.
+    '''
+
+    def __init__(self, opts, buffer_size=100):
+        self.opts = opts
+        self.buffer_size = buffer_size
+
+    def __call__(self, tgt, fun, arg=(), timeout=None, tgt_type='glob', kwarg=None):
+        '''
+        Execute ``fun`` on the targeted Minions, and return a :class:`Job`
+        which yields a dictionary ``{minion_id: {'ret': ..., 'retcode': ...,
+        'latency': ...}}`` for each Minion return, in the order they arrive.
+        ``latency`` is the number of seconds between the job publication and
+        the return. The Minions that didn't return within ``timeout`` seconds
+        are then available in the ``missing`` attribute of the job.
+        '''
+        if timeout is None:
+            timeout = self.opts['timeout']
+        job = Job(self.opts, self.buffer_size, timeout)
+        return job.publish(tgt, fun, arg=arg, tgt_type=tgt_type, kwarg=kwarg)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019-2020 Mircea Ulinic. All rights reserved.
+#
+# The contents of this file are licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+'''
+Memory accounting for the ISalt session, and the ``%isalt_mem`` magic.
+'''
+import gc
+import sys
+import time
+import tracemalloc
+import collections
+
+from IPython import get_ipython
+from IPython.core import magic_arguments
+
+try:
+    import salt_sproxy
+
+    SPROXY_PATH = list(salt_sproxy.__path__)[0]
+except ImportError:
+    SPROXY_PATH = None
+
+LOADERS = ('__salt__', '__runners__', '__utils__', '__proxy__')
+# The Proxy modules hold the connection to the device in their globals, and
+# the lazy reload wouldn't call their ``init`` again: never unload them.
+UNLOADABLE = ('__salt__', '__runners__', '__utils__')
+NFRAMES = 25
+DATA = ('__opts__', '__grains__', '__pillar__')
+
+
+def _fmt(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+    return '{:.1f} GiB'.format(size)
+
+
+def _deep_getsizeof(obj, seen=None):
+    '''
+    Return the size of ``obj``, including the size of the elements of the
+    dictionaries, lists, tuples and sets it contains.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _deep_getsizeof(key, seen) + _deep_getsizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _deep_getsizeof(item, seen)
+    return size
+
+
+def _module_files(loader):
+    '''
+    Return a dictionary mapping the name of each module loaded by ``loader``,
+    to the source file it has been loaded from.
+    '''
+    files = {}
+    for name, func in list(loader._dict.items()):
+        code = getattr(func, '__code__', None)
+        if code is not None:
+            files.setdefault(name.split('.')[0], code.co_filename)
+    return files
+
+
+class LoaderUsage(object):
+    '''
+    Record the last time each module of a Salt loader has been used, either
+    from the console, or from other Salt modules. The loader object is
+    altered in place.
+    '''
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.last_used = {}
+        usage = self
+        loader_cls = loader.__class__
+
+        def __getitem__(self, key):
+            usage.last_used[key.split('.')[0]] = time.time()
+            return loader_cls.__getitem__(self, key)
+
+        loader.__class__ = type(
+            loader_cls.__name__, (loader_cls,), {'__getitem__': __getitem__}
+        )
+
+    def unload(self, module):
+        '''
+        Drop the functions of ``module`` from the loader. The module is loaded
+        again, lazily, next time it is required.
+        '''
+        loader = self.loader
+        funcs = [name for name in loader._dict if name.split('.')[0] == module]
+        for name in funcs:
+            func = loader._dict.pop(name)
+            mod_name = getattr(func, '__module__', None) or ''
+            loader.loaded_files.discard(mod_name.rsplit('.', 1)[-1])
+            sys.modules.pop(mod_name, None)
+        loader.loaded_modules.pop(module, None)
+        if funcs:
+            # Once all the modules have been loaded (e.g., by ``sys.doc``), the
+            # loader doesn't look up the missing functions anymore.
+            loader.loaded = False
+        self.last_used.pop(module, None)
+        return len(funcs)
+
+
+class MemoryTracker(object):
+    '''
+    Take tracemalloc snapshots at the end of each startup phase, and report
+    the current memory usage per dunder and per loaded module. The module usage
+    is recorded, and the idle modules can be unloaded, even when tracemalloc is
+    not tracing.
+    '''
+
+    def __init__(self):
+        self.phases = []
+        self.loaders = {}
+        self.keep = set()
+        self.started_at = time.time()
+        self._snapshot = None
+
+    @property
+    def enabled(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        tracemalloc.start(NFRAMES)
+        self.started_at = time.time()
+        self._snapshot = tracemalloc.take_snapshot()
+
+    def checkpoint(self, phase):
+        '''
+        Record the memory allocated since the previous checkpoint, as the cost
+        of ``phase``. This is a no-op when tracemalloc is not tracing.
+        '''
+        if not self.enabled:
+            return
+        snapshot = tracemalloc.take_snapshot()
+        diff = snapshot.compare_to(self._snapshot, 'filename')
+        self.phases.append((phase, sum(stat.size_diff for stat in diff)))
+        self._snapshot = snapshot
+
+    def track(self, dunders):
+        '''
+        Wrap the loaders from ``dunders`` to record the module usage.
+        '''
+        opts = dunders.get('__opts__') or {}
+        proxytype = (opts.get('proxy') or {}).get('proxytype')
+        if proxytype:
+            self.keep.add(proxytype)
+        for name in LOADERS:
+            if dunders.get(name) is not None:
+                self.loaders[name] = LoaderUsage(dunders[name])
+
+    def unload(self, idle):
+        '''
+        Unload the modules not used in the past ``idle`` seconds. Returns the
+        list of modules unloaded, as ``dunder:module``.
+        '''
+        now = time.time()
+        unloaded = []
+        for name, usage in self.loaders.items():
+            if name not in UNLOADABLE:
+                continue
+            for module in list(usage.loader.loaded_modules):
+                if module in self.keep:
+                    continue
+                if now - usage.last_used.get(module, self.started_at) < idle:
+                    continue
+                if usage.unload(module):
+                    unloaded.append('{}:{}'.format(name, module))
+        gc.collect()
+        return unloaded
+
+    def report(self, user_ns, top=10):
+        '''
+        Return the memory report, as text.
+
+        The size of a module is the memory allocated while executing its code
+        (i.e., the module appears anywhere in the traceback of the allocation),
+        therefore it is partial: the bytecode is allocated by importlib and
+        is not accounted. The sizes overlap when a module calls another one.
+        '''
+        lines = []
+        if self.enabled:
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(
+                'Traced memory: {} (peak: {})'.format(_fmt(current), _fmt(peak))
+            )
+        else:
+            lines.append('Memory tracing is not enabled, start ISalt with --mem-trace')
+        if self.phases:
+            lines.extend(['', 'Startup phases:'])
+            for phase, size in self.phases:
+                lines.append('  {:<30} {:>12}'.format(phase, _fmt(size)))
+        stats = []
+        if self.enabled:
+            stats = [
+                (stat.size, set(frame.filename for frame in stat.traceback))
+                for stat in tracemalloc.take_snapshot().statistics('traceback')
+            ]
+        file_sizes = collections.defaultdict(int)
+        for size, filenames in stats:
+            for filename in filenames:
+                file_sizes[filename] += size
+        modules = []
+        lines.extend(['', 'Dunders (partial sizes):' if stats else 'Dunders:'])
+        for name in LOADERS:
+            if user_ns.get(name) is None:
+                continue
+            files = _module_files(user_ns[name])
+            if not stats:
+                lines.append('  {:<43}  ({} modules)'.format(name, len(files)))
+                continue
+            for module, path in files.items():
+                modules.append(('{}:{}'.format(name, module), file_sizes[path]))
+            paths = set(files.values())
+            total = sum(size for size, filenames in stats if filenames & paths)
+            lines.append(
+                '  {:<30} {:>12}  ({} modules)'.format(name, _fmt(total), len(files))
+            )
+        if user_ns.get('sproxy') is not None and SPROXY_PATH:
+            # The salt-sproxy modules are loaded through the Master loaders.
+            paths = set(
+                path
+                for name in LOADERS
+                if user_ns.get(name) is not None
+                for path in _module_files(user_ns[name]).values()
+                if path.startswith(SPROXY_PATH)
+            )
+            if stats:
+                total = sum(
+                    size
+                    for size, filenames in stats
+                    if any(filename.startswith(SPROXY_PATH) for filename in filenames)
+                )
+                lines.append(
+                    '  {:<30} {:>12}  ({} modules)'.format(
+                        'sproxy', _fmt(total), len(paths)
+                    )
+                )
+            else:
+                lines.append('  {:<43}  ({} modules)'.format('sproxy', len(paths)))
+        for name in DATA:
+            if user_ns.get(name) is not None:
+                size = _deep_getsizeof(user_ns[name])
+                lines.append('  {:<30} {:>12}'.format(name, _fmt(size)))
+        if modules:
+            lines.extend(['', 'Top {} loaded modules (partial sizes):'.format(top)])
+            modules.sort(key=lambda module: module[1], reverse=True)
+            for module, size in modules[:top]:
+                lines.append('  {:<30} {:>12}'.format(module, _fmt(size)))
+        return '\n'.join(lines)
+
+
+tracker = MemoryTracker()
+
+
+@magic_arguments.magic_arguments()
+@magic_arguments.argument(
+    '--top', type=int, default=10, help='The number of loaded modules to display.'
+)
+@magic_arguments.argument(
+    '--unload',
+    type=float,
+    metavar='SECONDS',
+    help=(
+        'Unload the modules not used in the past SECONDS seconds. The Proxy '
+        'modules are never unloaded.'
+    ),
+)
+def isalt_mem(line):
+    '''
+    Display the memory used by the ISalt session, per dunder and per loaded
+    module, or unload the modules not used recently.
+    '''
+    args = magic_arguments.parse_argstring(isalt_mem, line)
+    if args.unload is not None:
+        unloaded = tracker.unload(args.unload)
+        print('Unloaded {} modules: {}'.format(len(unloaded), ', '.join(unloaded)))
+        return
+    print(tracker.report(get_ipython().user_ns, top=args.top))
+
+
+def load_ipython_extension(ipython):
+    ipython.register_magic_function(isalt_mem, 'line', 'isalt_mem')
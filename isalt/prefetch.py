@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019-2020 Mircea Ulinic. All rights reserved.
+#
+# The contents of this file are licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+'''
+Background warm-up of the fileserver backends, for the ``--local`` mode.
+'''
+import time
+import logging
+import threading
+import collections
+
+import salt.fileclient
+import salt.fileserver
+
+log = logging.getLogger(__name__)
+
+CACHE_DIRS = ('_modules', '_states')
+
+
+def _remote_ids(remotes):
+    '''
+    Return the ID of each gitfs remote, i.e., the URL or the key of the
+    dictionary when the remote has per-remote configuration.
+    '''
+    ids = []
+    for remote in remotes or []:
+        if isinstance(remote, dict):
+            ids.extend(remote.keys())
+        else:
+            ids.append(remote)
+    return ids
+
+
+class Prefetch(object):
+    '''
+    Update the fileserver backends (one thread per backend), then pre-cache
+    the ``_modules`` and ``_states`` directories for the selected saltenv. The
+    progress is displayed when evaluating the object from the console prompt.
+
+    The gitfs remotes are initialised once, in the gitfs thread, as gitfs is
+    not safe to initialise concurrently in the same process. Then, each remote
+    is fetched in a separate thread, and finally the gitfs backend is updated,
+    which writes the environment cache.
+    '''
+
+    def __init__(self, opts, saltenv='base', cache_dirs=CACHE_DIRS):
+        self.opts = dict(opts)
+        self.saltenv = saltenv
+        self.cache_dirs = cache_dirs
+        self.tasks = collections.OrderedDict()
+        self._thread = None
+
+    def _tasks(self):
+        '''
+        Build the list of ``(backend, remotes)`` update tasks.
+        '''
+        tasks = []
+        for backend in self.opts.get('fileserver_backend', []):
+            remotes = []
+            if backend in ('git', 'gitfs'):
+                remotes = _remote_ids(self.opts.get('gitfs_remotes'))
+            tasks.append((backend, remotes))
+        return tasks
+
+    def _task_names(self, backend, remotes):
+        if not remotes:
+            return [backend]
+        names = ['{}:init'.format(backend)]
+        names.extend('{}:{}'.format(backend, remote) for remote in remotes)
+        names.append(backend)
+        return names
+
+    def _run(self, name, func, *args, **kwargs):
+        self.tasks[name] = {'status': 'running', 'start': time.time(), 'end': None}
+        try:
+            func(*args, **kwargs)
+            self.tasks[name]['status'] = 'done'
+        except Exception as err:  # pylint: disable=broad-except
+            log.error('Prefetch task %s failed', name, exc_info=True)
+            self.tasks[name]['status'] = 'failed: {}'.format(err)
+        self.tasks[name]['end'] = time.time()
+        return self.tasks[name]['status'] == 'done'
+
+    def _update(self, backend):
+        salt.fileserver.Fileserver(self.opts).update(back=[backend])
+
+    def _init_gitfs(self, gitfs):
+        # The same way the gitfs fileserver backend initialises the remotes.
+        import salt.utils.gitfs
+        import salt.fileserver.gitfs
+
+        gitfs['remotes'] = salt.utils.gitfs.GitFS(
+            self.opts,
+            self.opts['gitfs_remotes'],
+            per_remote_overrides=salt.fileserver.gitfs.PER_REMOTE_OVERRIDES,
+            per_remote_only=salt.fileserver.gitfs.PER_REMOTE_ONLY,
+        ).remotes
+
+    def _update_backend(self, backend, remotes):
+        gitfs = {}
+        if remotes and not self._run(
+            '{}:init'.format(backend), self._init_gitfs, gitfs
+        ):
+            for remote in remotes:
+                self.tasks['{}:{}'.format(backend, remote)]['status'] = 'skipped'
+        elif remotes:
+            threads = []
+            for repo in gitfs['remotes']:
+                thread = threading.Thread(
+                    target=self._run,
+                    args=('{}:{}'.format(backend, repo.id), repo.fetch),
+                )
+                thread.daemon = True
+                threads.append(thread)
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # Nothing left to fetch at this point, this only writes the env cache
+        # (or it updates the whole backend, when the initialisation failed).
+        self._run(backend, self._update, backend)
+
+    def _cache_dir(self, path):
+        client = salt.fileclient.get_file_client(self.opts)
+        client.cache_dir('salt://{}'.format(path), self.saltenv)
+
+    def _warm_up(self, updates):
+        threads = []
+        for backend, remotes in updates:
+            thread = threading.Thread(
+                target=self._update_backend, args=(backend, remotes)
+            )
+            thread.daemon = True
+            threads.append(thread)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for cache_dir in self.cache_dirs:
+            self._run('cache:salt://{}'.format(cache_dir), self._cache_dir, cache_dir)
+
+    def start(self):
+        '''
+        Start the warm-up in a background thread.
+        '''
+        updates = self._tasks()
+        for backend, remotes in updates:
+            for name in self._task_names(backend, remotes):
+                self.tasks[name] = {'status': 'pending', 'start': None, 'end': None}
+        for cache_dir in self.cache_dirs:
+            name = 'cache:salt://{}'.format(cache_dir)
+            self.tasks[name] = {'status': 'pending', 'start': None, 'end': None}
+        self._thread = threading.Thread(
+            target=self._warm_up, args=(updates,), name='isalt-prefetch'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    @property
+    def done(self):
+        '''
+        Whether the warm-up finished (regardless of errors).
+        '''
+        return self._thread is not None and not self._thread.is_alive()
+
+    def wait(self, timeout=None):
+        '''
+        Block until the warm-up finishes, or the timeout expires. Returns
+        ``True`` when the warm-up finished.
+        '''
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return self.done
+
+    def __repr__(self):
+        finished = len([t for t in list(self.tasks.values()) if t['end'] is not None])
+        lines = [
+            'Prefetch ({}): {}/{} tasks finished'.format(
+                self.saltenv, finished, len(self.tasks)
+            )
+        ]
+        for name, task in list(self.tasks.items()):
+            elapsed = ''
+            if task['start'] is not None:
+                end = task['end'] or time.time()
+                elapsed = ' ({:.1f}s)'.format(end - task['start'])
+            lines.append('  {}: {}{}'.format(name, task['status'], elapsed))
+        return '\n'.join(lines)
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019-2020 Mircea Ulinic. All rights reserved.
+#
+# The contents of this file are licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the
+# License. You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+'''
+Record the ``__proxy__`` and ``__salt__`` calls to a file, and replay them
+offline.
+'''
+import os
+import pickle
+import hashlib
+import logging
+import functools
+import threading
+import collections
+
+import salt.loader
+import salt.utils.json
+
+log = logging.getLogger(__name__)
+
+# The Proxy functions managing the connection to the device: they're not
+# recorded, and they're replaced with these stubs when replaying.
+PROXY_STUBS = {
+    'init': lambda *args, **kwargs: None,
+    'initialized': lambda *args, **kwargs: True,
+    'alive': lambda *args, **kwargs: True,
+    'shutdown': lambda *args, **kwargs: None,
+}
+
+
+class ReplayMissError(Exception):
+    '''
+    Raised when replaying a call that has not been recorded.
+    '''
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class CallStore(object):
+    '''
+    In ``record`` mode, execute the calls and append their arguments and
+    return (or exception) to the file at ``path``. In ``replay`` mode, load the
+    file into an in-memory index, and serve the calls from the index.
+
+    The calls are indexed by the function name, the arguments, and the digest
+    of the source file of the function: after editing a module, its
+    ``__salt__`` functions are executed again (while the calls they make can
+    still be replayed). Any other call not found in the index is reported as
+    a miss, and raises :class:`ReplayMissError`, unless ``live`` is ``True``,
+    in which case it is executed.
+
+    Only the calls of the functions accessed as ``__salt__['mod.fun']`` are
+    captured: the attribute access, i.e., ``__salt__.mod.fun``, bypasses the
+    store.
+    '''
+
+    def __init__(self, path, mode='replay', live=False):
+        self.path = path
+        self.mode = mode
+        self.live = live
+        self.index = {}
+        self.sources = collections.defaultdict(set)
+        self.hits = 0
+        self.misses = []
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._fh = None
+        if mode == 'replay':
+            self.load()
+        else:
+            self._fh = open(path, 'ab')
+
+    def load(self):
+        '''
+        Load the recorded calls into the index. The returns are kept pickled,
+        and unpickled on every hit, so the callers can't alter them.
+        '''
+        with open(self.path, 'rb') as fh:
+            while True:
+                try:
+                    key, ok, value = pickle.load(fh)
+                except EOFError:
+                    break
+                except Exception:  # pylint: disable=broad-except
+                    # The recording session died while writing the last call.
+                    log.warning(
+                        'Unable to read %s past the call #%d, ignoring the rest',
+                        self.path,
+                        len(self.index),
+                        exc_info=True,
+                    )
+                    break
+                self.index[key] = (ok, value)
+                self.sources[key[:2]].add(key[2])
+
+    def _source_digest(self, func):
+        func = getattr(func, 'func', func)
+        code = getattr(func, '__code__', None)
+        if code is None:
+            return None
+        path = code.co_filename
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        if self._sources.get(path, (None,))[0] != mtime:
+            with open(path, 'rb') as fh:
+                self._sources[path] = (mtime, _digest(fh.read()))
+        return self._sources[path][1]
+
+    def _key(self, dunder, fun, func, args, kwargs):
+        try:
+            call = salt.utils.json.dumps([args, kwargs], sort_keys=True, default=repr)
+        except TypeError:
+            # E.g., dictionaries with keys of different types can't be sorted.
+            call = repr((args, sorted(kwargs.items(), key=repr)))
+        call = call.encode('utf-8')
+        return (dunder, fun, self._source_digest(func), _digest(call))
+
+    def _write(self, key, ok, value):
+        try:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:  # pylint: disable=broad-except
+            log.warning('Unable to record the %s call', key[1], exc_info=True)
+            return
+        frame = pickle.dumps((key, ok, value), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._fh.write(frame)
+            self._fh.flush()
+        self.index[key] = (ok, value)
+
+    def call(self, dunder, fun, func, *args, **kwargs):
+        '''
+        Execute, or replay, the ``func`` call.
+        '''
+        key = self._key(dunder, fun, func, args, kwargs)
+        if self.mode == 'replay':
+            if key in self.index:
+                self.hits += 1
+                ok, value = self.index[key]
+                value = pickle.loads(value)
+                if ok:
+                    return value
+                raise value
+            self.misses.append('{}[{!r}]'.format(dunder, fun))
+            changed = dunder == '__salt__' and key[2] not in self.sources[key[:2]]
+            if self.live or changed:
+                return func(*args, **kwargs)
+            raise ReplayMissError(
+                '{}[{!r}] has not been recorded with these arguments'.format(
+                    dunder, fun
+                )
+            )
+        try:
+            value = func(*args, **kwargs)
+        except Exception as err:
+            self._write(key, False, err)
+            raise
+        self._write(key, True, value)
+        return value
+
+    def patch(self, dunder, loader):
+        '''
+        Route the calls of the functions from ``loader`` through the store. The
+        loader object is altered in place, so the calls made from inside the
+        Salt modules are equally captured.
+        '''
+        store = self
+        loader_cls = loader.__class__
+        if getattr(loader_cls, '_isalt_call_store', None) is self:
+            return
+
+        def __getitem__(self, key):
+            if dunder == '__proxy__' and key.split('.')[-1] in PROXY_STUBS:
+                if store.mode == 'replay':
+                    return PROXY_STUBS[key.split('.')[-1]]
+                return loader_cls.__getitem__(self, key)
+            func = loader_cls.__getitem__(self, key)
+            if not callable(func):
+                return func
+
+            @functools.wraps(getattr(func, 'func', func))
+            def wrapper(*args, **kwargs):
+                return store.call(dunder, key, func, *args, **kwargs)
+
+            return wrapper
+
+        loader.__class__ = type(
+            loader_cls.__name__,
+            (loader_cls,),
+            {'__getitem__': __getitem__, '_isalt_call_store': self},
+        )
+
+    def install(self):
+        '''
+        Patch the Proxy and Execution Module loaders as soon as Salt creates
+        them, i.e., before the Proxy Minion connects to the device.
+        '''
+        for name, dunder in (('proxy', '__proxy__'), ('minion_mods', '__salt__')):
+            self._install(name, dunder)
+
+    def _install(self, name, dunder):
+        create_loader = getattr(salt.loader, name)
+
+        @functools.wraps(create_loader)
+        def wrapper(*args, **kwargs):
+            loader = create_loader(*args, **kwargs)
+            self.patch(dunder, loader)
+            return loader
+
+        setattr(salt.loader, name, wrapper)
+
+    def __repr__(self):
+        lines = [
+            '{} ({}): {} calls in the index'.format(
+                self.mode.title(), self.path, len(self.index)
+            )
+        ]
+        if self.mode == 'replay':
+            lines.append('  hits: {}'.format(self.hits))
+            lines.append('  misses: {}'.format(len(self.misses)))
+            for miss, count in sorted(collections.Counter(self.misses).items()):
+                lines.append('    {} ({})'.format(miss, count))
+        return '\n'.join(lines)
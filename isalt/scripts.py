@@ -38,6 +38,11 @@ except ImportError:
 import IPython
 import traitlets.config.loader
 
+import isalt.events
+import isalt.memory
+import isalt.replay
+import isalt.prefetch
+
 BANNER = '''\
  __       _______.     ___       __      .___________.
 |  |     /       |    /   \     |  |     |           |
@@ -50,10 +55,23 @@ BANNER = '''\
 '''
 
 
+ROLES = ('minion', 'proxy', 'sproxy', 'master', 'master,minion')
+
+
 class ISaltError(Exception):
     pass
 
 
+def _is_true(value):
+    '''
+    Evaluate a boolean option, that may be provided as a string, e.g., from an
+    environment variable.
+    '''
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
 def main():
     """
     The entry point to the ISalt console.
@@ -126,6 +144,16 @@ def main():
     parser.add_argument(
         '--master', action='store_true', help='Prepare the Salt dunders for the Master.'
     )
+    parser.add_argument(
+        '--role',
+        help=(
+            'The Salt role to prepare the dunders for: master, minion, proxy, '
+            'sproxy, or master,minion to load both the Runners and the '
+            'Execution Modules in the same console.\n'
+            'This option takes precedence over --minion, --proxy, --sproxy, and '
+            '--master.'
+        ),
+    )
     parser.add_argument(
         '--local',
         action='store_true',
@@ -153,9 +181,62 @@ def main():
             'This option is ignored when used in conjunction with --master.'
         ),
     )
+    parser.add_argument(
+        '--no-prefetch',
+        action='store_false',
+        dest='prefetch',
+        help=(
+            'Do not warm up the fileserver backends and the file client cache in '
+            'background, when starting with --local.'
+        ),
+    )
+    parser.add_argument(
+        '--mem-trace',
+        action='store_true',
+        dest='mem_trace',
+        help=(
+            'Trace the memory allocations with tracemalloc, to report the memory '
+            'usage through the %%isalt_mem magic.'
+        ),
+    )
+    parser.add_argument(
+        '--record',
+        metavar='PATH',
+        help=(
+            'Record the __proxy__ and __salt__ calls, together with their '
+            'return, into the file at this path.'
+        ),
+    )
+    parser.add_argument(
+        '--replay',
+        metavar='PATH',
+        help=(
+            'Replay the __proxy__ and __salt__ calls recorded into the file at '
+            'this path (see --record).'
+        ),
+    )
+    parser.add_argument(
+        '--replay-live',
+        action='store_true',
+        dest='replay_live',
+        help=(
+            'When replaying, execute the calls that have not been recorded, '
+            'including the __proxy__ calls, instead of raising an error.'
+        ),
+    )
     args = parser.parse_args()
     isalt_cfg = salt.config.load_config(args.cfg_file, args.cfg_file_env_var)
 
+    mem_trace = args.mem_trace or _is_true(
+        os.environ.get('ISALT_MEM_TRACE', isalt_cfg.get('mem_trace', False))
+    )
+    if mem_trace:
+        isalt.memory.tracker.start()
+    record = args.record or os.environ.get('ISALT_RECORD', isalt_cfg.get('record'))
+    replay = args.replay or os.environ.get('ISALT_REPLAY', isalt_cfg.get('replay'))
+    if record and replay:
+        raise ISaltError('Please use either --record or --replay, not both')
+
     on_master = args.on_master or os.environ.get(
         'ISALT_ON_MASTER', isalt_cfg.get('on_master', False)
     )
@@ -166,14 +247,28 @@ def main():
         'ISALT_PROXYTYPE', isalt_cfg.get('proxytype')
     )
     role = os.environ.get('ISALT_ROLE', isalt_cfg.get('role', 'minion'))
-    if args.sproxy:
-        role = 'sproxy'
-    if args.minion or minion_id:
-        role = 'minion'
-    if args.proxy or proxytype:
-        role = 'proxy'
-    if args.master:
-        role = 'master'
+    if args.role:
+        role = args.role
+    else:
+        if args.sproxy:
+            role = 'sproxy'
+        if args.minion or minion_id:
+            role = 'minion'
+        if args.proxy or proxytype:
+            role = 'proxy'
+        if args.master:
+            role = 'master'
+    if ',' in role:
+        role = ','.join(sorted(r.strip() for r in role.split(',')))
+    if role not in ROLES:
+        raise ISaltError(
+            'Unsupported role: {}. Choose between: {}'.format(role, ', '.join(ROLES))
+        )
+    if role == 'master,minion' and (args.minion_id or args.proxytype or args.local):
+        raise ISaltError(
+            'The --minion-id, --proxytype, and --local options are not supported '
+            'with the master,minion role'
+        )
     if role == 'sproxy':
         if not HAS_SPROXY:
             raise ISaltError('salt-sproxy doesn\'t seem to be installed')
@@ -233,11 +328,29 @@ def main():
         __opts__['id'] = minion_id
     elif role in ('master', 'sproxy'):
         __opts__ = salt.config.master_config(master_cfg_file)
+    elif role == 'master,minion':
+        __opts__ = master_opts
     __opts__['saltenv'] = args.saltenv
     __opts__['pillarenv'] = args.pillarenv
+    isalt.memory.tracker.checkpoint('__opts__')
+
+    call_store = None
+    if record:
+        call_store = isalt.replay.CallStore(record, mode='record')
+    elif replay:
+        if not os.path.isfile(replay):
+            raise ISaltError('Unable to replay the calls: {} not found'.format(replay))
+        call_store = isalt.replay.CallStore(
+            replay, mode='replay', live=args.replay_live
+        )
+    if call_store and role in ('minion', 'proxy', 'master,minion'):
+        # Before the Proxy Minion is initialised, so the connection to the
+        # device can be skipped when replaying.
+        call_store.install()
 
     __utils__ = None
     __proxy__ = None
+    __runners__ = None
     __grains__ = None
     __pillar__ = None
 
@@ -275,14 +388,18 @@ def main():
             __pillar__ = pillar[minion_id] if pillar and minion_id in pillar else {}
             if __pillar__ and 'proxy' in __pillar__:
                 __opts__['proxy'] = __pillar__['proxy']
+            isalt.memory.tracker.checkpoint('__grains__, __pillar__')
 
             __utils__ = salt.loader.utils(__opts__)
+            isalt.memory.tracker.checkpoint('__utils__')
             __proxy__ = salt.loader.proxy(__opts__, utils=__utils__)
+            isalt.memory.tracker.checkpoint('__proxy__')
             __salt__ = salt.loader.minion_mods(
                 __opts__,
                 utils=__utils__,
                 proxy=__proxy__,
             )
+            isalt.memory.tracker.checkpoint('__salt__')
         else:
             if not os.path.exists(__opts__['cachedir']):
                 try:
@@ -319,6 +436,7 @@ def main():
 
                 if __pillar__ and 'proxy' in __pillar__:
                     __opts__['proxy'] = __pillar__['proxy']
+                isalt.memory.tracker.checkpoint('__grains__, __pillar__')
 
                 if salt.version.__version_info__ >= (2019, 2, 0):
                     sminion = salt.minion.SProxyMinion(__opts__)
@@ -327,8 +445,10 @@ def main():
             __proxy__ = sminion.proxy
             __utils__ = sminion.utils
             __salt__ = sminion.functions
+            isalt.memory.tracker.checkpoint('sminion')
             __grains__ = __opts__['grains']
             __pillar__ = __salt__['pillar.items']()
+            isalt.memory.tracker.checkpoint('__pillar__')
     elif role in ('master', 'sproxy'):
         if role == 'sproxy':
             saltenv = __opts__['saltenv']
@@ -354,7 +474,24 @@ def main():
                 if sproxy_dir_path not in __opts__[sproxy_dirs_opts]:
                     __opts__[sproxy_dirs_opts].append(sproxy_dir_path)
         __utils__ = salt.loader.utils(__opts__)
+        isalt.memory.tracker.checkpoint('__utils__')
         __salt__ = salt.loader.runner(__opts__, utils=__utils__)
+        isalt.memory.tracker.checkpoint('__salt__')
+    elif role == 'master,minion':
+        # Same as the salt.cmd Runner: the Execution Modules are loaded using
+        # the Master opts, and share the __utils__ with the Runners.
+        __opts__['grains'] = salt.loader.grains(__opts__)
+        __grains__ = __opts__['grains']
+        isalt.memory.tracker.checkpoint('__grains__')
+        __utils__ = salt.loader.utils(__opts__)
+        isalt.memory.tracker.checkpoint('__utils__')
+        __runners__ = salt.loader.runner(__opts__, utils=__utils__)
+        isalt.memory.tracker.checkpoint('__runners__')
+        __salt__ = salt.loader.minion_mods(__opts__, utils=__utils__)
+        isalt.memory.tracker.checkpoint('__salt__')
+
+    if call_store and role in ('master', 'sproxy'):
+        call_store.patch('__salt__', __salt__)
 
     dunders = {
         'salt': salt,
@@ -367,6 +504,19 @@ def main():
     }
     if role == 'sproxy':
         dunders['sproxy'] = __salt__['proxy.execute']
+    if call_store:
+        dunders['replay'] = call_store
+    if role == 'master,minion':
+        dunders['__runners__'] = __runners__
+    if role in ('master', 'master,minion'):
+        dunders['stream'] = isalt.events.JobStream(__opts__)
+    if role in ('minion', 'proxy') and local:
+        if args.prefetch and _is_true(
+            os.environ.get('ISALT_PREFETCH', isalt_cfg.get('prefetch', True))
+        ):
+            prefetch = isalt.prefetch.Prefetch(__opts__, saltenv=args.saltenv)
+            dunders['prefetch'] = prefetch.start()
+    isalt.memory.tracker.track(dunders)
     sys.argv = sys.argv[:1]
 
     ipy_cfg = traitlets.config.loader.Config()
@@ -374,6 +524,7 @@ def main():
         ipy_cfg.TerminalInteractiveShell.term_title_format = 'ISalt'
     else:
         ipy_cfg.TerminalInteractiveShell.term_title = False
+    ipy_cfg.InteractiveShellApp.extensions = ['isalt.memory']
     ipy_cfg.InteractiveShell.banner1 = BANNER + '''\n
            Role: {role}
         Salt version: {salt_ver}
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+'''
+Tests for the event bus job streaming, against a Master (and at least one
+Minion connected to it) running on the same machine.
+
+The tests are skipped unless ``ISALT_TEST_MASTER_CONFIG`` points to the Master
+configuration file, e.g.,
+
+.. code-block:: bash
+
+    $ ISALT_TEST_MASTER_CONFIG=/etc/salt/master python -m pytest tests/
+'''
+import os
+import time
+
+import pytest
+
+pytest.importorskip('salt')
+
+import salt.config  # noqa: E402
+
+import isalt.events  # noqa: E402
+
+MASTER_CONFIG = os.environ.get('ISALT_TEST_MASTER_CONFIG')
+
+pytestmark = pytest.mark.skipif(
+    not MASTER_CONFIG, reason='ISALT_TEST_MASTER_CONFIG is not set'
+)
+
+
+@pytest.fixture
+def stream():
+    return isalt.events.JobStream(salt.config.master_config(MASTER_CONFIG))
+
+
+def test_stream_returns(stream):
+    job = stream('*', 'test.ping', timeout=10)
+    targeted = list(job.missing)
+    assert targeted
+    returns = {}
+    for ret in job:
+        returns.update(ret)
+    assert sorted(returns) == targeted
+    assert job.missing == []
+    for ret in returns.values():
+        assert ret['ret'] is True
+        assert 0 <= ret['latency'] <= 10
+
+
+def test_stream_iterate_after_timeout(stream):
+    job = stream('*', 'test.ping', timeout=5)
+    targeted = list(job.missing)
+    # The returns that arrived in time are still yielded.
+    time.sleep(6)
+    returns = {}
+    for ret in job:
+        returns.update(ret)
+    assert sorted(returns) == targeted
+    assert job.missing == []